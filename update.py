@@ -1,14 +1,22 @@
 """
 Get ready for 1.0.0
 """
+import ast
+import copy
+import functools
+import io
+import itertools
 import logging
-import platform
+import logging.handlers
+import multiprocessing
 import os
 import re
 import sys
 import subprocess
 
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 from redbaron import RedBaron
 import ruamel.yaml
 
@@ -17,42 +25,138 @@ logging.basicConfig(format="%(levelname)-10s%(message)s", level=logging.INFO)
 
 SUBDIRS = ("modules", "action")
 SPECIALS = {"ospfv2": "OSPFv2", "interfaces": "Interfaces", "static": "Static"}
+# version_added lines preceded by 1+ spaces, [ \t] keeps the match on one line
+_VA_RE = re.compile(r"^[ \t]+version_added:[ \t].*\n?", re.MULTILINE)
+# a single round trip instance, reused for every document
+_YAML = ruamel.yaml.YAML(typ="rt")
+_YAML.preserve_quotes = True
 
-def load_py_as_ast(path):
+
+@functools.lru_cache(maxsize=None)
+def _yaml_load_cached(text):
+    """
+    Load a yaml string, caching the result
+
+    The same docstring is loaded several times per file, the result
+    must be deep copied before it is modified
+
+    :param text: The yaml string
+    :return: The loaded yaml
+    """
+    return _YAML.load(text)
+
+
+def _ydumps(obj):
+    """
+    Dump an object to a yaml string
+
+    :param obj: The object to dump
+    :return: The yaml string
+    """
+    buf = io.StringIO()
+    _YAML.dump(obj, buf)
+    return buf.getvalue()
+
+
+def load_py_as_ast(data, filename):
     """
-    Load a file as an ast object
+    Load the contents of a file as an ast object
 
-    :param path: The full path to the file
+    :param data: The contents of the file
+    :param filename: The full path to the file
     :return: The ast object
     """
-    with open(path) as file:
-        data = file.read()
-        red = RedBaron(data)
-    return red
+    return ast.parse(data, filename=filename)
 
 
-def find_assigment_in_ast(name, ast_file):
+def _line_offsets(data, linenos):
     """
-    Find an assignment in an ast object
+    Find the offset of the start of each line, only scanning the
+    file as far as the last line needed
 
-    :param name: The name of the assignement to find
-    :param ast_file: The ast object
-    :return: A list of ast object matching
+    :param data: The contents of the file
+    :param linenos: The zero based line numbers
+    :return: A dict of line number to offset
     """
-    res = ast_file.find("assignment", target=lambda x: x.dumps() == name)
+    res = {}
+    line = pos = 0
+    for lineno in sorted(set(linenos)):
+        while line < lineno:
+            found = data.find("\n", pos)
+            pos = len(data) if found == -1 else found + 1
+            line += 1
+        res[lineno] = pos
     return res
 
 
-def remove_assigment_in_ast(name, ast_file):
+def find_all_assignments(ast_file, data, names):
     """
-    REmoves an assignment in an ast object
+    Find the top level assignments in an ast object in a single pass
 
-    :param name: The name of the assignement to remove
     :param ast_file: The ast object
+    :param data: The contents of the file
+    :param names: The names of the assignments to find
+    :return: A dict of name to the span of the first assignment matching
     """
-    res = ast_file.find("assignment", target=lambda x: x.dumps() == name)
-    if res:
-        ast_file.remove(res)
+    lines = {}
+    for node in ast_file.body:
+        if not (
+            isinstance(node, ast.Assign)
+            and isinstance(node.targets[0], ast.Name)
+            and node.col_offset == 0
+        ):
+            continue
+        target = node.targets[0].id
+        if target in names and target not in lines:
+            lines[target] = (node.lineno - 1, node.end_lineno)
+    offsets = _line_offsets(data, itertools.chain.from_iterable(lines.values()))
+    return {
+        name: (offsets[start], offsets[end]) for name, (start, end) in lines.items()
+    }
+
+
+def load_assignment(data, span):
+    """
+    Load only the lines of an assignment as a redbaron object
+
+    :param data: The contents of the file
+    :param span: The span of the assignment
+    :return: The assignment
+    """
+    red = RedBaron(data[span[0] : span[1]])
+    return red[0]
+
+
+def remove_assigment_in_ast(name, assigns):
+    """
+    REmoves an assignment, it is dropped when the file is spliced
+
+    :param name: The name of the assignement to remove
+    :param assigns: The dict of name to assignment
+    """
+    assigns.pop(name, None)
+
+
+def splice_assignments(data, spans, assigns):
+    """
+    Put the updated assignments back into the file,
+    everything else is left byte for byte as it was
+
+    :param data: The contents of the file
+    :param spans: The dict of name to span
+    :param assigns: The dict of name to assignment, missing ones are removed
+    :return: The contents of the file
+    """
+    buf = io.StringIO()
+    pos = 0
+    for name, (start, end) in sorted(spans.items(), key=lambda item: item[1]):
+        buf.write(data[pos:start])
+        bodypart = assigns.get(name)
+        if bodypart:
+            buf.write(bodypart.root.dumps())
+        pos = end
+    buf.write(data[pos:])
+    return buf.getvalue()
 
 
 def retrieve_module_name(bodypart):
@@ -65,26 +169,24 @@ def retrieve_module_name(bodypart):
     if not bodypart:
         logging.warning("Failed to find DOCUMENTATION assignment")
         return
-    documentation = ruamel.yaml.load(
-        bodypart.value.to_python(), ruamel.yaml.RoundTripLoader
-    )
+    documentation = _yaml_load_cached(bodypart.value.to_python())
 
     name = documentation["module"]
     return name
 
 
-def update_documentation(bodypart):
+def update_documentation_and_short(doc_bp, ret_bp, module_name):
     """
-    Update the docuementation of the module
+    Update the docuementation and short description of the module
 
-    :param bodypart: The DOCUMENTATION section of the module
+    :param doc_bp: The DOCUMENTATION section of the module
+    :param ret_bp: The RETURN section of the module
+    :param module_name: The module name
     """
-    if not bodypart:
+    if not doc_bp:
         logging.warning("Failed to find DOCUMENTATION assignment")
         return
-    documentation = ruamel.yaml.load(
-        bodypart.value.to_python(), ruamel.yaml.RoundTripLoader
-    )
+    documentation = copy.deepcopy(_yaml_load_cached(doc_bp.value.to_python()))
     # remove version added
     documentation.pop("version_added", None)
     desc_idx = [
@@ -92,13 +194,33 @@ def update_documentation(bodypart):
     ]
     # insert version_added after the description
     documentation.insert(desc_idx[0] + 1, key="version_added", value="1.0.0")
-    repl = ruamel.yaml.dump(documentation, None, ruamel.yaml.RoundTripDumper)
+    update_short_description(
+        retrn=ret_bp, doc_section=documentation, module_name=module_name
+    )
+    repl = _ydumps(documentation)
 
     # remove version added from anywhere else in the docstring if preceded by 1+ spaces
-    example_lines = repl.splitlines()
-    regex = re.compile(r"^\s+version_added\:\s.*$")
-    example_lines = [l for l in example_lines if not re.match(regex, l)]
-    bodypart.value.replace('"""\n' + "\n".join(example_lines) + '\n"""')
+    repl = _VA_RE.sub("", repl).rstrip("\n")
+    doc_bp.value.replace('"""\n' + repl + '\n"""')
+
+
+@functools.lru_cache(maxsize=None)
+def _comment_module_re(module_name, full_module_name):
+    """
+    Build the regex matching the comment lines that mention the module
+    but not yet the fully qualified name
+
+    :param module_name: The name of the module
+    :param full_module_name: The fully qualified name of the module
+    :return: The compiled regex
+    """
+    return re.compile(
+        r"^(?!.*{full})#.*{short}.*$".format(
+            full=re.escape(full_module_name), short=re.escape(module_name)
+        ),
+        re.MULTILINE,
+    )
+
 
 def update_examples(bodypart, module_name, collection):
     """
@@ -115,68 +237,57 @@ def update_examples(bodypart, module_name, collection):
     full_module_name = "{collection}.{module_name}".format(
         collection=collection, module_name=module_name
     )
-    example = ruamel.yaml.load(bodypart.value.to_python(), ruamel.yaml.RoundTripLoader)
-    # check each task and update to fqcn
-    for idx, task in enumerate(example):
-        example[idx] = ruamel.yaml.comments.CommentedMap(
-            [
-                (full_module_name, v) if k == module_name else (k, v)
-                for k, v in task.items()
-            ]
-        )
-    repl = ruamel.yaml.dump(example, None, ruamel.yaml.RoundTripDumper)
+    example = _YAML.load(bodypart.value.to_python())
+    # check each task and update to fqcn, in place to keep the comments
+    for task in example:
+        if module_name in task:
+            position = list(task.keys()).index(module_name)
+            task.insert(position, full_module_name, task.pop(module_name))
+    repl = _ydumps(example)
 
     # look in yaml comments for the module name as well and replace
-    example_lines = repl.splitlines()
-    for idx, line in enumerate(example_lines):
-        if (
-            line.startswith("#")
-            and module_name in line
-            and module_name
-            and full_module_name not in line
-        ):
-            example_lines[idx] = line.replace(module_name, full_module_name)
-    bodypart.value.replace('"""\n' + "\n".join(example_lines) + '\n"""')
+    repl = _comment_module_re(module_name, full_module_name).sub(
+        lambda match: match.group(0).replace(module_name, full_module_name), repl
+    )
+    bodypart.value.replace('"""\n' + repl.rstrip("\n") + '\n"""')
 
 
+def _resource_name(parts):
+    """
+    Build the resource name used in a resource module short description
 
-def update_short_description(retrn, documentation, module_name):
+    :param parts: The module name split on underscores
+    :return: The resource name
+    """
+    # things like 'interfaces'
+    resource = SPECIALS.get(parts[1].lower(), parts[1].upper())
+    if resource[-1] == "S":
+        resource = resource[:-1] + "s"
+    if len(parts) > 2 and parts[2] != "global":
+        resource += " {p1}".format(p1=parts[2])
+    return resource
+
+
+def update_short_description(retrn, doc_section, module_name):
     """
     Update the short description of the module
 
-    :param bodypart: The DOCUMENTATION section of the module
+    :param retrn: The RETURN section of the module
+    :param doc_section: The loaded DOCUMENTATION, updated in place
     :param module_name: The module name
     """
     if not retrn:
         logging.warning("Failed to find RETURN assignment")
         return
-    ret_section = ruamel.yaml.load(retrn.value.to_python(), ruamel.yaml.RoundTripLoader)
-    if not documentation:
-        logging.warning("Failed to find DOCUMENTATION assignment")
-        return
-    doc_section = ruamel.yaml.load(
-        documentation.value.to_python(), ruamel.yaml.RoundTripLoader
-    )
     short_description = doc_section['short_description']
     
     rm_rets = ["after", "before", "commands"]
+    ret_section = _yaml_load_cached(retrn.value.to_python())
     if ret_section:
         match = [x for x in rm_rets if x in list(ret_section.keys())]
         if len(match) == len(rm_rets):
             logging.info("Found a resource module")
-            parts = module_name.split("_")
-            # things like 'interfaces'
-            resource = parts[1].lower()
-            if resource in SPECIALS:
-                resource = SPECIALS[resource]
-            else:
-                resource = resource.upper()
-            if resource.lower()[-1].endswith("s"):
-                chars = list(resource)
-                chars[-1] = chars[-1].lower()
-                resource = "".join(chars)
-            if len(parts) > 2 and parts[2] != "global":
-                resource += " {p1}".format(p1=parts[2])
+            resource = _resource_name(module_name.split("_"))
             short_description = "{resource} resource module".format(resource=resource)
     # Check for deprecated modules
     if 'deprecated' in doc_section and not short_description.startswith('(deprecated)'):
@@ -186,87 +297,163 @@ def update_short_description(retrn, documentation, module_name):
     if short_description != doc_section['short_description']:
         logging.info("Setting short desciption to '%s'", short_description)
         doc_section["short_description"] = short_description
-        repl = ruamel.yaml.dump(doc_section, None, ruamel.yaml.RoundTripDumper)
-        documentation.value.replace('"""\n' + repl + '\n"""')
 
 
+def black(filenames):
+    """
+    Run black against the files
+
+    :param filenames: The full paths to the files
+    """
+    if not filenames:
+        return
+    logging.info("Running black against %s files", len(filenames))
+    subprocess.check_output(["black", "-q", *filenames])
+
+
+def _init_worker(queue):
+    """
+    Send the log records of a worker process to the parent
+
+    :param queue: The queue the parent listens on
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(queue)]
+
+
+def _process_one(filename, collection):
+    """
+    Process a single file in a worker, logging the filename with
+    any failure since the worker output is interleaved
+
+    :param filename: The full path to the file
+    :param collection: The name of the collection
+    :return: The filename if it was written
+    """
+    try:
+        return _update_file(filename, collection)
+    except Exception:
+        logging.exception("Failed processing %s", filename)
+        raise
+
 
-def black(filename):
+def _update_file(filename, collection):
     """
-    Run black against the file
+    Update a single file
 
     :param filename: The full path to the file
+    :param collection: The name of the collection
+    :return: The filename if it was written
     """
-    logging.info("Running black against %s", filename)
-    subprocess.check_output(["black", "-q", filename])
+    logging.info("-------------------Processing %s", filename)
+    _yaml_load_cached.cache_clear()
+    data = Path(filename).read_bytes()
+    # most action plugins have no documentation, don't parse them at all
+    if b"DOCUMENTATION" not in data:
+        logging.warning("Failed to find DOCUMENTATION assignment")
+        logging.warning("Skipped %s: No module name found", filename)
+        return
+    existing = data.decode("utf-8")
+    ast_obj = load_py_as_ast(existing, filename)
+    spans = find_all_assignments(
+        ast_file=ast_obj,
+        data=existing,
+        names={"DOCUMENTATION", "ANSIBLE_METADATA", "RETURN", "EXAMPLES"},
+    )
+    assigns = {name: load_assignment(existing, span) for name, span in spans.items()}
+
+    # Get the module naem from the docstring
+    module_name = retrieve_module_name(assigns.get("DOCUMENTATION"))
+    if not module_name:
+        logging.warning("Skipped %s: No module name found", filename)
+        return
+
+    # Remove the metadata
+    remove_assigment_in_ast(name="ANSIBLE_METADATA", assigns=assigns)
+    logging.info("Removed metadata in %s", filename)
+
+    # Update the documentation and short description
+    update_documentation_and_short(
+        doc_bp=assigns.get("DOCUMENTATION"),
+        ret_bp=assigns.get("RETURN"),
+        module_name=module_name,
+    )
+    logging.info("Updated documentation in %s", filename)
+
+    # Update the examples
+    update_examples(
+        bodypart=assigns.get("EXAMPLES"),
+        module_name=module_name,
+        collection=collection,
+    )
+    logging.info("Updated examples in %s", filename)
+
+    # Write out the file if changed, black is run once all are written
+    filec = splice_assignments(existing, spans, assigns)
+    if filec == existing:
+        logging.info("No changes to %s", filename)
+        return
+    Path(filename).write_text(filec, encoding="utf-8")
+    logging.info("Wrote %s", filename)
+    return filename
 
 
 def process(collection, path):
     """
     Process the files in each subdirectory
     """
+    paths = []
     for subdir in SUBDIRS:
         dirpath = "{colpath}{collection}/plugins/{subdir}".format(
             colpath=path, collection=collection, subdir=subdir
         )
-        for filename in os.listdir(dirpath):
-            if filename.endswith(".py"):
-                filename = "{dirpath}/{filename}".format(
-                    dirpath=dirpath, filename=filename
-                )
-                logging.info("-------------------Processing %s", filename)
-                ast_obj = load_py_as_ast(filename)
-
-                # Get the module naem from the docstring
-                module_name = retrieve_module_name(
-                    find_assigment_in_ast(ast_file=ast_obj, name="DOCUMENTATION")
-                )
-                if not module_name:
-                    logging.warning("Skipped %s: No module name found", filename)
+        with os.scandir(dirpath) as entries:
+            paths.extend(
+                entry.path
+                for entry in entries
+                if entry.name.endswith(".py") and entry.is_file(follow_symlinks=False)
+            )
+
+    # Files are independent, process them in parallel and
+    # have the workers log through the parent
+    queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(
+        queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    written = []
+    failed = 0
+    listener.start()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), initializer=_init_worker, initargs=(queue,)
+        ) as executor:
+            futures = [
+                executor.submit(_process_one, filename, collection)
+                for filename in paths
+            ]
+            for future in as_completed(futures):
+                try:
+                    filename = future.result()
+                except Exception:  # pylint: disable=broad-except
+                    # already logged with the filename by the worker
+                    failed += 1
                     continue
-
-                # Remove the metadata
-                remove_assigment_in_ast(ast_file=ast_obj, name="ANSIBLE_METADATA")
-                logging.info("Removed metadata in %s", filename)
-
-                # Update the documentation
-                update_documentation(
-                    bodypart=find_assigment_in_ast(
-                        ast_file=ast_obj, name="DOCUMENTATION"
-                    )
-                )
-                logging.info("Updated documentation in %s", filename)
-
-                # Update the short description
-                update_short_description(
-                    retrn=find_assigment_in_ast(ast_file=ast_obj, name="RETURN"),
-                    documentation=find_assigment_in_ast(
-                        ast_file=ast_obj, name="DOCUMENTATION"
-                    ),
-                    module_name=module_name,
-                )
-
-                # Update the examples
-                update_examples(
-                    bodypart=find_assigment_in_ast(ast_file=ast_obj, name="EXAMPLES"),
-                    module_name=module_name,
-                    collection=collection,
-                )
-                logging.info("Updated examples in %s", filename)
-
-                # Write out the file and black
-                filec = ast_obj.dumps()
-                with open(filename, "w") as fileh:
-                    fileh.write(filec)
-                    logging.info("Wrote %s", filename)
-                black(filename)
+                if filename:
+                    written.append(filename)
+    finally:
+        listener.stop()
+        # black whatever was written, even if a file failed
+        black(written)
+    if failed:
+        logging.error("Failed processing %s files", failed)
+        sys.exit(1)
 
 
 def main():
     """
     The entry point
     """
-    if not platform.python_version().startswith("3.8"):
+    if sys.version_info < (3, 8):
         sys.exit("Python 3.8+ required")
     parser = ArgumentParser()
     parser.add_argument(